@@ -1,111 +1,574 @@
-import gzip
-import json
+import os
+import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import yaml
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+# Prefer the libyaml C parser: cassettes embed large base64 bodies that the
+# pure-Python loader is very slow to scan
+try:
+    from yaml import CBaseLoader as BaseLoader, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import BaseLoader, SafeLoader
+
+# pybase64 decodes the !!binary response bodies with SIMD instead of binascii
+try:
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode
+
+# ISA-L inflates gzip with SIMD-tuned code, several times faster than zlib
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+# orjson parses straight from bytes and is several times faster than json
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    import json
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+
+# simdjson can pick single fields out of a document without building the rest of it
+try:
+    import simdjson
+
+    SIMDJSON_PARSER = simdjson.Parser()
+except ImportError:
+    simdjson = None
+
+# gzip stream signature, and the wbits selecting gzip framing for zlib.decompress
+GZIP_MAGIC = b"\x1f\x8b"
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# Below this compressed size zlib's cheaper one-shot setup beats ISA-L's faster inflate
+ISAL_MIN_SIZE = 1024
+
+# Images are sent as base64 data URLs inside the recorded request bodies
+IMAGE_DATA_URL = re.compile(rb"data:image/[\w.+-]+;base64,([A-Za-z0-9+/]*=*)")
+
+METRIC_COLUMNS = [
+    "file_name",
+    "jpeg_size_bytes",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "processing_time_ms",
+    "x_request_id",
+]
+# Response headers read by the line scanner; the metrics need no others
+SCANNED_HEADERS = frozenset(["openai-processing-ms", "x-request-id"])
+
+NUMERIC_METRIC_COLUMNS = [
+    "jpeg_size_bytes",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "processing_time_ms",
+]
+
+# Cassettes are immutable once recorded, so their metrics are cached next to them,
+# keyed on each cassette's mtime and size; bump the version when the metrics change
+ANALYSIS_CACHE_NAME = ".analyze_cache.json"
+ANALYSIS_CACHE_VERSION = 3
+
+
+def gunzip(compressed):
+    """
+    Decompress a gzip stream, using ISA-L for bodies large enough to benefit.
 
-def parse_cassette_binary(binary_content):
+    Args:
+        compressed (bytes): gzip-framed data.
+
+    Returns:
+        bytes: The decompressed data.
+
+    Raises:
+        zlib.error or isal_zlib.error: If the data is not valid gzip.
     """
-    Parse the binary content of a VCR cassette's response body into a dictionary.
+    if isal_zlib is None or len(compressed) < ISAL_MIN_SIZE:
+        return zlib.decompress(compressed, GZIP_WBITS)
+    return isal_zlib.decompress(compressed, wbits=GZIP_WBITS)
+
+
+def decode_cassette_body(binary_content):
+    """
+    Turn the binary content of a VCR cassette's response body into uncompressed JSON bytes.
 
     Args:
         binary_content (str or bytes): Binary content of the response body.
 
     Returns:
-        dict: Parsed JSON response.
+        bytes: The JSON document.
     """
     # Ensure binary_content is in bytes
     if isinstance(binary_content, str):
         binary_content = binary_content.encode("latin1")
 
-    try:
-        # Check if the content is compressed (gzip)
-        decoded_content = gzip.decompress(binary_content).decode("utf-8")
-    except (OSError, UnicodeDecodeError):
-        # If not compressed, assume it's plain JSON
-        decoded_content = binary_content.decode("utf-8")
+    # Check the gzip magic bytes rather than paying for a failed decompress
+    if binary_content[:2] == GZIP_MAGIC:
+        return gunzip(binary_content)
 
-    # Load the JSON content
-    response_json = json.loads(decoded_content)
-    return response_json
+    # If not compressed, assume it's plain JSON
+    return binary_content
 
 
-def analyze_cassettes_with_tokens_and_jpeg_sizes(
-    cassettes_dir, output_dir, converted_dir
-):
+def parse_cassette_binary(binary_content):
     """
-    Analyze VCR cassettes to summarize token usage, processing time, and JPEG file sizes.
+    Parse the binary content of a VCR cassette's response body into a dictionary.
 
     Args:
-        cassettes_dir (Path): Path to the directory containing VCR cassettes.
-        output_dir (Path): Path to the directory containing the converted JPEGs.
+        binary_content (str or bytes): Binary content of the response body.
 
     Returns:
-        pd.DataFrame: DataFrame with file metrics and processing data.
+        dict: Parsed JSON response.
     """
-    metrics = []
+    # Load the JSON content straight from the UTF-8 bytes
+    return json_loads(decode_cassette_body(binary_content))
 
-    for cassette_file in cassettes_dir.glob("*.yaml"):
-        with open(cassette_file, "r") as f:
-            cassette_data = yaml.safe_load(f)
 
-        for interaction in cassette_data.get("interactions", []):
-            # Extract binary response body
-            response_body = (
-                interaction.get("response", {}).get("body", {}).get("string", "")
-            )
-            headers = interaction.get("response", {}).get("headers", {})
-
-            # Parse response content
-            if response_body:
-                parsed_response = parse_cassette_binary(response_body)
-                usage = parsed_response.get("usage", {})
-                token_metrics = {
-                    "prompt_tokens": usage.get("prompt_tokens"),
-                    "completion_tokens": usage.get("completion_tokens"),
-                    "total_tokens": usage.get("total_tokens"),
-                }
-            else:
-                token_metrics = {
-                    "prompt_tokens": None,
-                    "completion_tokens": None,
-                    "total_tokens": None,
-                }
-
-            # Extract header metrics
-            processing_time = headers.get("openai-processing-ms", [None])[0]
-            x_request_id = headers.get("x-request-id", [None])[0]
-
-            # Get size of the corresponding JPEG in the correct directory
-            file_name = cassette_file.stem
-            if file_name.endswith(".pdf"):
-                jpeg_file = converted_dir / cassette_file.stem.replace(".pdf", ".jpg")
-            else:
-                jpeg_file = output_dir / file_name
-            if jpeg_file.exists():
-                file_size = jpeg_file.stat().st_size
+def parse_cassette_usage(binary_content):
+    """
+    Extract only the token usage from the binary content of a VCR cassette's response body.
+
+    With pysimdjson installed just the "usage" object is materialised; otherwise the whole
+    response is parsed with parse_cassette_binary.
+
+    Args:
+        binary_content (str or bytes): Binary content of the response body.
+
+    Returns:
+        dict: The response's usage block, empty if it has none.
+    """
+    if simdjson is None:
+        return parse_cassette_binary(binary_content).get("usage") or {}
+
+    document = SIMDJSON_PARSER.parse(decode_cassette_body(binary_content))
+    usage = document.get("usage")
+    return usage.as_dict() if isinstance(usage, simdjson.Object) else {}
+
+
+def request_image_size(request_body):
+    """
+    Total the decoded size of the images sent as base64 data URLs in a request body.
+
+    Base64 has no spaces for YAML to fold at, so each data URL stays on one line and the
+    raw cassette lines can be searched as well as the parsed body.
+
+    Args:
+        request_body (bytes): The request body, or the cassette lines holding it.
+
+    Returns:
+        int: Size in bytes, or None if the request sent no images.
+    """
+    encoded_images = IMAGE_DATA_URL.findall(request_body)
+    if not encoded_images:
+        return None
+    return sum(len(data) * 3 // 4 - data.count(b"=") for data in encoded_images)
+
+
+def iter_cassette_responses(cassette_file):
+    """
+    Stream the response body and headers of each interaction in a VCR cassette.
+
+    Walks the YAML event stream instead of loading the whole document, keeping only the
+    size of the images in each request body.
+
+    Args:
+        cassette_file (str or Path): Path to the VCR cassette.
+
+    Yields:
+        dict: {"body": response body bytes, "headers": {name: first value},
+            "image_size": bytes of images sent or None} per interaction.
+    """
+    # One [path, pending key or next index, is_mapping] frame per open collection
+    frames = []
+    interaction = None
+
+    with open(cassette_file, "rb") as f:
+        for event in yaml.parse(f, Loader=SafeLoader):
+            if isinstance(event, yaml.CollectionEndEvent):
+                path = frames.pop()[0]
+                if len(path) == 2 and path[0] == "interactions":
+                    yield interaction
+            elif not isinstance(event, yaml.NodeEvent):
+                # Stream and document markers
+                continue
+            elif frames and frames[-1][2] and frames[-1][1] is None:
+                # A mapping key; the next node event is its value
+                frames[-1][1] = event.value
+                continue
             else:
-                file_size = None
-
-            # Collect data for this interaction
-            metrics.append(
-                {
-                    "file_name": cassette_file.name.replace(".yaml", ""),
-                    "jpeg_size_bytes": file_size,
-                    "prompt_tokens": token_metrics["prompt_tokens"],
-                    "completion_tokens": token_metrics["completion_tokens"],
-                    "total_tokens": token_metrics["total_tokens"],
-                    "processing_time_ms": (
-                        int(processing_time) if processing_time else None
-                    ),
-                    "x_request_id": x_request_id,
-                }
+                path = frames[-1][0] + (frames[-1][1],) if frames else ()
+
+                if isinstance(event, yaml.CollectionStartEvent):
+                    is_mapping = isinstance(event, yaml.MappingStartEvent)
+                    frames.append([path, None if is_mapping else 0, is_mapping])
+                    if len(path) == 2 and path[0] == "interactions":
+                        interaction = {"body": None, "headers": {}, "image_size": None}
+                    continue
+
+                if path[2:] == ("request", "body"):
+                    if event.tag == "tag:yaml.org,2002:binary":
+                        request_body = b64decode(event.value)
+                    else:
+                        request_body = event.value.encode("utf-8")
+                    interaction["image_size"] = request_image_size(request_body)
+                elif path[2:] == ("response", "body", "string"):
+                    if event.tag == "tag:yaml.org,2002:binary":
+                        interaction["body"] = b64decode(event.value)
+                    else:
+                        # Text bodies are stored decoded; VCR replays them as UTF-8
+                        interaction["body"] = event.value.encode("utf-8")
+                elif path[2:] == ("response", "body", "base64_string"):
+                    interaction["body"] = b64decode(event.value)
+                elif path[2:4] == ("response", "headers") and path[5:] == (0,):
+                    interaction["headers"][path[4]] = event.value
+
+            # The value is complete; move the parent on to its next key or item
+            if frames:
+                if frames[-1][2]:
+                    frames[-1][1] = None
+                else:
+                    frames[-1][1] += 1
+
+
+class CassetteFormatError(ValueError):
+    """Raised when a cassette is not laid out the way VCR writes them."""
+
+
+def read_indented_block(f, first_line, indent):
+    """
+    Collect a line and the lines indented beneath it, such as a multi-line scalar.
+
+    Args:
+        f (file): Cassette opened in binary mode, positioned after first_line.
+        first_line (bytes): The line that opens the block.
+        indent (bytes): Leading spaces that mark a line as part of the block.
+
+    Returns:
+        tuple: (lines in the block, the first line after it or b"" at the end).
+    """
+    block = [first_line]
+    line = f.readline()
+    while line.startswith(indent) or line == b"\n":
+        block.append(line)
+        line = f.readline()
+    return block, line
+
+
+def scan_header_value(block):
+    """
+    Read the first value of a response header from its sequence item lines.
+
+    Args:
+        block (list): The item line and any continuation lines, as bytes.
+
+    Returns:
+        str: The header value.
+    """
+    value = block[0][8:].rstrip(b"\n")
+    if len(block) == 1:
+        # Single-quoted or plain one-line scalars, which covers nearly every header
+        if value[:1] == value[-1:] == b"'" and b"'" not in value[1:-1]:
+            return value[1:-1].decode("utf-8")
+        if value[:1].isalnum() and b": " not in value and b" #" not in value:
+            return value.decode("utf-8")
+
+    return yaml.load(b"".join(block), Loader=BaseLoader)[0]
+
+
+def scan_cassette_body(block):
+    """
+    Decode a response body from its "string:" lines.
+
+    Args:
+        block (list): The "string:" line and the lines of its value, as bytes.
+
+    Returns:
+        bytes: The response body.
+    """
+    if block[0] == b"      string: !!binary |\n":
+        # b64decode skips the indentation and line breaks
+        return b64decode(b"".join(block[1:]))
+
+    # Text bodies are quoted scalars; hand just this snippet to the YAML parser
+    return yaml.load(b"".join(block), Loader=BaseLoader)["string"].encode("utf-8")
+
+
+def scan_cassette_responses(cassette_file):
+    """
+    Read the response body and headers of each interaction with a line scanner.
+
+    VCR writes cassettes in a fixed layout, so responses can be found from the
+    indentation alone and the large request bodies skipped without a YAML parse.
+
+    Args:
+        cassette_file (str or Path): Path to the VCR cassette.
+
+    Returns:
+        list: {"body": response body bytes, "headers": {name: first value},
+            "image_size": bytes of images sent or None} per interaction, with headers
+            limited to SCANNED_HEADERS.
+
+    Raises:
+        CassetteFormatError: If the cassette is not in VCR's layout.
+    """
+    responses = []
+    response = None
+    section = None
+    header = None
+    image_size = None
+
+    with open(cassette_file, "rb") as f:
+        if f.readline() != b"interactions:\n":
+            raise CassetteFormatError(f"{cassette_file}: expected an interactions list")
+
+        line = f.readline()
+        while line:
+            if line.startswith(b"- "):
+                # A new interaction, which VCR always opens with its request
+                if line != b"- request:\n":
+                    raise CassetteFormatError(
+                        f"{cassette_file}: unexpected {line[:40]!r}"
+                    )
+                response = None
+                image_size = None
+            elif line.startswith(b"  ") and line[2:3] != b" ":
+                # A key of the interaction itself
+                if line == b"  response:\n":
+                    response = {"body": None, "headers": {}, "image_size": image_size}
+                    responses.append(response)
+                    section = header = None
+                else:
+                    response = None
+            elif line == b"\n":
+                pass
+            elif not line.startswith(b" "):
+                # Only the version may follow the interactions
+                if not line.startswith(b"version:"):
+                    raise CassetteFormatError(
+                        f"{cassette_file}: unexpected {line[:40]!r}"
+                    )
+            elif response is None:
+                # Inside the request only the body matters, for the images it sent
+                if line.startswith(b"    body:"):
+                    block, line = read_indented_block(f, line, b"      ")
+                    if block[0].startswith(b"    body: !!binary"):
+                        image_size = request_image_size(b64decode(b"".join(block[1:])))
+                    else:
+                        image_size = request_image_size(b"".join(block))
+                    continue
+            elif line.startswith(b"    ") and line[4:5] != b" ":
+                # A key of the response
+                if line not in (b"    body:\n", b"    headers:\n", b"    status:\n"):
+                    raise CassetteFormatError(
+                        f"{cassette_file}: unexpected {line[:40]!r}"
+                    )
+                section = line
+            elif section == b"    body:\n":
+                # Other encodings, such as base64_string, are left to the YAML parser
+                if not line.startswith(b"      string:"):
+                    raise CassetteFormatError(
+                        f"{cassette_file}: unexpected {line[:40]!r}"
+                    )
+                block, line = read_indented_block(f, line, b"        ")
+                response["body"] = scan_cassette_body(block)
+                continue
+            elif section == b"    headers:\n":
+                if line.startswith(b"      - "):
+                    block, line = read_indented_block(f, line, b"        ")
+                    if header in SCANNED_HEADERS and header not in response["headers"]:
+                        response["headers"][header] = scan_header_value(block)
+                    continue
+                if line[6:7] == b" " or not line.endswith(b":\n"):
+                    raise CassetteFormatError(
+                        f"{cassette_file}: unexpected {line[:40]!r}"
+                    )
+                header = line[6:-2].decode("utf-8")
+            elif section != b"    status:\n":
+                raise CassetteFormatError(f"{cassette_file}: unexpected {line[:40]!r}")
+
+            line = f.readline()
+
+    return responses
+
+
+def read_cassette_responses(cassette_file):
+    """
+    Read the responses of a VCR cassette, scanning lines when the layout allows.
+
+    Args:
+        cassette_file (str or Path): Path to the VCR cassette.
+
+    Returns:
+        iterable: {"body": response body bytes, "headers": {name: first value}} per
+            interaction; see scan_cassette_responses and iter_cassette_responses.
+    """
+    try:
+        return scan_cassette_responses(cassette_file)
+    except CassetteFormatError:
+        # Fall back to parsing the YAML events
+        return iter_cassette_responses(cassette_file)
+
+
+def analyze_cassette(cassette_file):
+    """
+    Collect image size, token usage and processing time for each interaction in one cassette.
+
+    Args:
+        cassette_file (str): Path to the VCR cassette.
+
+    Returns:
+        dict: One list per entry in METRIC_COLUMNS, with a value per distinct
+            non-empty response.
+    """
+    file_name = os.path.basename(cassette_file).replace(".yaml", "")
+    metrics = {column: [] for column in METRIC_COLUMNS}
+    seen_request_ids = set()
+
+    for interaction in read_cassette_responses(cassette_file):
+        response_body = interaction["body"]
+        headers = interaction["headers"]
+        x_request_id = headers.get("x-request-id")
+
+        # Skip empty responses and replays of a response already counted
+        if not response_body or x_request_id in seen_request_ids:
+            continue
+        if x_request_id:
+            seen_request_ids.add(x_request_id)
+
+        # Parse response content
+        usage = parse_cassette_usage(response_body)
+
+        # Collect data for this interaction
+        metrics["file_name"].append(file_name)
+        metrics["jpeg_size_bytes"].append(interaction["image_size"])
+        metrics["prompt_tokens"].append(usage.get("prompt_tokens"))
+        metrics["completion_tokens"].append(usage.get("completion_tokens"))
+        metrics["total_tokens"].append(usage.get("total_tokens"))
+        metrics["processing_time_ms"].append(headers.get("openai-processing-ms"))
+        metrics["x_request_id"].append(x_request_id)
+
+    return metrics
+
+
+def load_analysis_cache(cache_file):
+    """
+    Load cached cassette metrics, ignoring a missing, unreadable, or outdated cache.
+
+    Args:
+        cache_file (Path): Path to the cache file.
+
+    Returns:
+        dict: {cassette name: {"mtime_ns": int, "size": int, "metrics": dict}}.
+    """
+    try:
+        with open(cache_file, "rb") as f:
+            cache = json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+    if cache.get("version") != ANALYSIS_CACHE_VERSION:
+        return {}
+    return cache.get("cassettes", {})
+
+
+def save_analysis_cache(cache_file, cassettes):
+    """
+    Write cassette metrics to the cache file; failing to write only loses the cache.
+
+    Args:
+        cache_file (Path): Path to the cache file.
+        cassettes (dict): Entries in the format returned by load_analysis_cache.
+    """
+    try:
+        with open(cache_file, "wb") as f:
+            f.write(
+                json_dumps({"version": ANALYSIS_CACHE_VERSION, "cassettes": cassettes})
             )
+    except OSError:
+        pass
+
+
+def analyze_cassettes_with_tokens_and_jpeg_sizes(cassettes_dir):
+    """
+    Analyze VCR cassettes to summarize token usage, processing time, and JPEG file sizes.
 
-    return pd.DataFrame(metrics)
+    The JPEG size is the total of the images in each recorded request, so it is what
+    was actually sent, whether one image or one per PDF page.
+
+    Cassettes are independent, so new or changed ones are parsed in parallel worker
+    processes; unchanged ones are read from the cache left by the previous run.
+
+    Args:
+        cassettes_dir (Path): Path to the directory containing VCR cassettes.
+
+    Returns:
+        pd.DataFrame: DataFrame with file metrics and processing data.
+    """
+    cache_file = cassettes_dir / ANALYSIS_CACHE_NAME
+    cached = load_analysis_cache(cache_file)
+
+    # scandir yields names and file types without building a Path per entry
+    with os.scandir(cassettes_dir) as dir_entries:
+        cassette_entries = sorted(
+            (e for e in dir_entries if e.name.endswith(".yaml") and e.is_file()),
+            key=lambda e: e.name,
+        )
+
+    cassettes = {}
+    stale_files = []
+    for cassette_entry in cassette_entries:
+        stat = cassette_entry.stat()
+        entry = cached.get(cassette_entry.name)
+        if (
+            entry is None
+            or entry["mtime_ns"] != stat.st_mtime_ns
+            or entry["size"] != stat.st_size
+        ):
+            entry = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+            stale_files.append(cassette_entry.path)
+        cassettes[cassette_entry.name] = entry
+
+    if stale_files:
+        workers = os.cpu_count() or 1
+
+        # Send cassettes to workers in chunks to amortise IPC, while keeping
+        # several chunks per worker so the load stays balanced
+        chunksize = max(1, len(stale_files) // (workers * 4))
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for cassette_file, cassette_metrics in zip(
+                stale_files,
+                executor.map(analyze_cassette, stale_files, chunksize=chunksize),
+            ):
+                cassettes[os.path.basename(cassette_file)]["metrics"] = cassette_metrics
+
+    if stale_files or cassettes.keys() != cached.keys():
+        save_analysis_cache(cache_file, cassettes)
+
+    # Collect one list per column and build the DataFrame in a single pass
+    metrics = {column: [] for column in METRIC_COLUMNS}
+    for entry in cassettes.values():
+        for column, values in entry["metrics"].items():
+            metrics[column].extend(values)
+
+    df = pd.DataFrame(metrics, columns=METRIC_COLUMNS)
+
+    # Convert whole columns at once to nullable integers; missing values become <NA>
+    for column in NUMERIC_METRIC_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors="coerce").astype("Int64")
+
+    return df
 
 
 def plot_relationships_with_consistent_coloring(df):
@@ -215,14 +678,11 @@ def plot_relationships_with_consistent_coloring(df):
     plt.show()
 
 
-# Example Usage
-CASSETTES_DIR = Path("tests/cassettes")  # Update to your cassettes directory
-OUTPUT_DIR = Path("files")  # Directory with the original files
-CONVERTED_DIR = Path("output_images")
-df = analyze_cassettes_with_tokens_and_jpeg_sizes(
-    CASSETTES_DIR, OUTPUT_DIR, CONVERTED_DIR
-)
+if __name__ == "__main__":
+    # Example Usage
+    CASSETTES_DIR = Path("tests/cassettes")  # Update to your cassettes directory
+    df = analyze_cassettes_with_tokens_and_jpeg_sizes(CASSETTES_DIR)
 
-# Display DataFrame and plot
-print(df)
-plot_relationships_with_consistent_coloring(df)
+    # Display DataFrame and plot
+    print(df.to_string())
+    plot_relationships_with_consistent_coloring(df)
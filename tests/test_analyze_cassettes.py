@@ -0,0 +1,145 @@
+import base64
+import json
+import os
+import shutil
+import pytest
+import yaml
+from tests.analyze_cassettes import (
+    ANALYSIS_CACHE_NAME,
+    SCANNED_HEADERS,
+    CassetteFormatError,
+    analyze_cassette,
+    analyze_cassettes_with_tokens_and_jpeg_sizes,
+    iter_cassette_responses,
+    read_cassette_responses,
+    request_image_size,
+    scan_cassette_responses,
+)
+
+CASSETTES_DIR = "tests/cassettes"
+CASSETTE_FILES = sorted(
+    entry.path for entry in os.scandir(CASSETTES_DIR) if entry.name.endswith(".yaml")
+)
+INVOICE_CASSETTE = os.path.join(CASSETTES_DIR, "invoice_1.pdf.yaml")
+
+
+def parse_events(cassette_file):
+    """
+    Read a cassette with the YAML event parser, keeping only the scanned headers.
+    """
+    return [
+        {
+            "body": response["body"],
+            "image_size": response["image_size"],
+            "headers": {
+                name: value
+                for name, value in response["headers"].items()
+                if name in SCANNED_HEADERS
+            },
+        }
+        for response in iter_cassette_responses(cassette_file)
+    ]
+
+
+def load_cassette(cassette_file):
+    with open(cassette_file, "rb") as f:
+        return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+@pytest.mark.parametrize("cassette_file", CASSETTE_FILES)
+def test_scanner_matches_event_parser(cassette_file):
+    responses = scan_cassette_responses(cassette_file)
+
+    assert responses
+    assert responses == parse_events(cassette_file)
+
+
+def test_non_vcr_layout_falls_back_to_event_parser(tmp_path):
+    cassette_file = tmp_path / "invoice_1.pdf.yaml"
+    with open(cassette_file, "w") as f:
+        yaml.safe_dump(load_cassette(INVOICE_CASSETTE), f, default_flow_style=True)
+
+    with pytest.raises(CassetteFormatError):
+        scan_cassette_responses(cassette_file)
+
+    responses = list(read_cassette_responses(cassette_file))
+    assert responses[0]["body"] == scan_cassette_responses(INVOICE_CASSETTE)[0]["body"]
+
+
+def test_base64_string_body_falls_back_to_event_parser(tmp_path):
+    cassette = load_cassette(INVOICE_CASSETTE)
+    body = cassette["interactions"][0]["response"]["body"]
+    body["base64_string"] = base64.b64encode(body.pop("string")).decode("ascii")
+
+    cassette_file = tmp_path / "invoice_1.pdf.yaml"
+    with open(cassette_file, "w") as f:
+        yaml.safe_dump(cassette, f)
+
+    with pytest.raises(CassetteFormatError):
+        scan_cassette_responses(cassette_file)
+
+    assert analyze_cassette(str(cassette_file)) == analyze_cassette(INVOICE_CASSETTE)
+
+
+def test_request_image_size_totals_every_page():
+    pages = [b"\xff\xd8page one", b"\xff\xd8second page!", b"\xff\xd8p3"]
+    request_body = json.dumps(
+        {
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [{"type": "text", "text": "Classify this"}]
+                    + [
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": "data:image/jpeg;base64,"
+                                + base64.b64encode(page).decode("ascii")
+                            },
+                        }
+                        for page in pages
+                    ],
+                }
+            ]
+        }
+    ).encode("utf-8")
+
+    assert request_image_size(request_body) == sum(len(page) for page in pages)
+    assert (
+        request_image_size(b'{"url": "data:application/pdf;base64,JVBERi0="}') is None
+    )
+
+
+def set_cached_prompt_tokens(cassettes_dir, cassette_name, prompt_tokens):
+    cache_file = cassettes_dir / ANALYSIS_CACHE_NAME
+    cache = json.loads(cache_file.read_bytes())
+    cache["cassettes"][cassette_name]["metrics"]["prompt_tokens"] = [prompt_tokens]
+    cache_file.write_text(json.dumps(cache))
+
+
+def test_analysis_cache_is_invalidated_by_changes(tmp_path, monkeypatch):
+    cassettes_dir = tmp_path / "cassettes"
+    cassettes_dir.mkdir()
+    for name in ["invoice_1.pdf.yaml", "drivers_license_1.jpg.yaml"]:
+        shutil.copy(os.path.join(CASSETTES_DIR, name), cassettes_dir)
+    cassette_file = cassettes_dir / "invoice_1.pdf.yaml"
+
+    def invoice_prompt_tokens():
+        df = analyze_cassettes_with_tokens_and_jpeg_sizes(cassettes_dir)
+        return df.set_index("file_name").loc["invoice_1.pdf", "prompt_tokens"]
+
+    assert invoice_prompt_tokens() == 25602
+
+    # Unchanged cassettes are answered from the cache
+    set_cached_prompt_tokens(cassettes_dir, cassette_file.name, 1)
+    assert invoice_prompt_tokens() == 1
+
+    # Touching a cassette re-parses it
+    stat = cassette_file.stat()
+    os.utime(cassette_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert invoice_prompt_tokens() == 25602
+
+    # So does a new cache version
+    set_cached_prompt_tokens(cassettes_dir, cassette_file.name, 1)
+    monkeypatch.setattr("tests.analyze_cassettes.ANALYSIS_CACHE_VERSION", 999)
+    assert invoice_prompt_tokens() == 25602
@@ -1,10 +1,35 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import mmap
 import os
 import re
+import tempfile
+from contextlib import closing
+import diskcache
 import pytest
 import vcr
+import yaml
 from io import BytesIO
+from PIL import Image
 from werkzeug.datastructures import FileStorage
-from src.openai_classifier import classify_file, create_filestorage_from_path
+from src.openai_classifier import (
+    CLASSIFICATION_CACHE_SIZE,
+    ContentCache,
+    classify_file,
+    classify_files,
+    classify_files_async,
+    convert_pdf_to_jpeg,
+    create_filestorage_from_path,
+    document_analysis_response_format,
+    downscale_image,
+    open_file_bytes,
+    parse_batch_output,
+    sniff_mime_type,
+    split_batch_input,
+)
 
 # Directory to store VCR cassettes
 CASSETTES_DIR = "tests/cassettes"
@@ -12,13 +37,12 @@ os.makedirs(CASSETTES_DIR, exist_ok=True)
 
 # Files to test
 FILES_DIR = "files"
-TEST_FILES = [
-    os.path.join(FILES_DIR, f)
-    for f in os.listdir(FILES_DIR)
-    if os.path.isfile(os.path.join(FILES_DIR, f))
-]
+TEST_FILES = [entry.path for entry in os.scandir(FILES_DIR) if entry.is_file()]
+
+# Trailing "_<number>" suffix distinguishing test files of the same classification
+TRAILING_NUMBER = re.compile(r"_\d+$")
 
-# Define the VCR configuration with a before_record hook
+# Shared VCR configuration for every recorded test
 vcr_config = vcr.VCR(
     cassette_library_dir=CASSETTES_DIR,
     record_mode="once",
@@ -27,6 +51,33 @@ vcr_config = vcr.VCR(
 )
 
 
+@pytest.fixture(autouse=True)
+def fresh_caches(monkeypatch):
+    """
+    Give every test empty, memory-only caches, whatever CLASSIFIER_CACHE_DIR says.
+    """
+    monkeypatch.setattr(
+        "src.openai_classifier.classification_cache",
+        ContentCache(CLASSIFICATION_CACHE_SIZE, None),
+    )
+    monkeypatch.setattr("src.openai_classifier.page_cache", None)
+
+
+@functools.lru_cache(maxsize=None)
+def read_file_bytes(file_path):
+    """
+    Read a test file once per session; the recorded requests need only its bytes.
+
+    Args:
+        file_path (str): The file path.
+
+    Returns:
+        bytes: The file contents.
+    """
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
 def get_classification(file_path):
     """
     Extracts the base name of a file, removing trailing numbers and extensions.
@@ -44,7 +95,7 @@ def get_classification(file_path):
     base_name, _ = os.path.splitext(file_name)
 
     # Remove trailing numbers with an underscore
-    base_name = re.sub(r"_\d+$", "", base_name)
+    base_name = TRAILING_NUMBER.sub("", base_name)
 
     if base_name == "drivers_license":
         return "drivers_licence"
@@ -54,14 +105,280 @@ def get_classification(file_path):
 
 @pytest.mark.parametrize("file_path", TEST_FILES)
 def test_classify_file(file_path):
-    cassette_path = os.path.join(CASSETTES_DIR, f"{os.path.basename(file_path)}.yaml")
+    cassette_name = f"{os.path.basename(file_path)}.yaml"
 
-    with vcr.use_cassette(cassette_path, record_mode="once"):
-        # Convert the file path to a FileStorage object
-        file_storage = create_filestorage_from_path(file_path)
+    with vcr_config.use_cassette(cassette_name):
+        # Wrap the cached file bytes in a FileStorage object
+        file_storage = FileStorage(
+            stream=BytesIO(read_file_bytes(file_path)),
+            filename=os.path.basename(file_path),
+        )
 
         # Call the classify_file function
         response = classify_file(file_storage)
 
         # Validate the response structure
         assert response == get_classification(file_path)
+
+
+def make_png(size):
+    buffer = BytesIO()
+    Image.new("RGB", size, "white").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_downscale_image_leaves_small_images_untouched():
+    image_bytes = make_png((800, 600))
+
+    assert downscale_image(image_bytes, "image/png") == (image_bytes, "image/png")
+
+
+def test_downscale_image_shrinks_large_images_to_jpeg():
+    image_bytes, mime_type = downscale_image(make_png((4000, 3000)), "image/png")
+
+    assert mime_type == "image/jpeg"
+    with Image.open(BytesIO(image_bytes)) as img:
+        assert img.format == "JPEG"
+        assert img.size == (2048, 1536)
+
+
+def batch_output(*records):
+    """
+    Build Batch API output JSONL from (custom_id, message) pairs of successful requests.
+    """
+    return "\n".join(
+        json.dumps(
+            {
+                "custom_id": custom_id,
+                "response": {
+                    "status_code": 200,
+                    "body": {"choices": [{"message": message}]},
+                },
+                "error": None,
+            }
+        )
+        for custom_id, message in records
+    )
+
+
+def analysis_message(document_type):
+    return {"content": json.dumps({"document_type": document_type, "notes": ""})}
+
+
+def test_classify_files_uses_batch_api(mocker):
+    client = mocker.patch("src.openai_classifier.get_client").return_value
+    client.batches.create.return_value = mocker.Mock(
+        id="batch_1", status="completed", output_file_id="file_out"
+    )
+    client.files.content.return_value.text = batch_output(
+        ("1", analysis_message("invoice")), ("0", analysis_message("drivers_licence"))
+    )
+
+    files = [
+        FileStorage(stream=BytesIO(make_png((10, 10))), filename=name)
+        for name in ["licence.png", "invoice.png", "broken.png"]
+    ]
+
+    assert classify_files(files) == ["drivers_licence", "invoice", None]
+
+    batch_input = client.files.create.call_args.kwargs["file"][1]
+    requests = [json.loads(line) for line in batch_input.splitlines()]
+    assert [r["custom_id"] for r in requests] == ["0", "1", "2"]
+    assert requests[0]["url"] == "/v1/chat/completions"
+
+
+def test_classify_files_batches_only_uncached_files(mocker):
+    cached, uncached = make_png((10, 10)), make_png((20, 20))
+    query_gpt4 = mocker.patch("src.openai_classifier.query_gpt4")
+    query_gpt4.return_value.choices[0].message.parsed.document_type = "invoice"
+    classify_file(FileStorage(stream=BytesIO(cached), filename="cached.png"))
+
+    client = mocker.patch("src.openai_classifier.get_client").return_value
+    client.batches.create.return_value = mocker.Mock(
+        id="batch_1", status="completed", output_file_id="file_out"
+    )
+    client.files.content.return_value.text = batch_output(
+        ("1", analysis_message("bank_statement"))
+    )
+
+    files = [
+        FileStorage(stream=BytesIO(cached), filename="cached.png"),
+        FileStorage(stream=BytesIO(uncached), filename="uncached.png"),
+    ]
+    assert classify_files(files) == ["invoice", "bank_statement"]
+
+    batch_input = client.files.create.call_args.kwargs["file"][1]
+    assert [json.loads(line)["custom_id"] for line in batch_input.splitlines()] == ["1"]
+
+    # Batch results are cached for later requests too
+    client.reset_mock()
+    files = [FileStorage(stream=BytesIO(uncached), filename="uncached.png")]
+    assert classify_files(files) == ["bank_statement"]
+    client.files.create.assert_not_called()
+
+
+def test_parse_batch_output_skips_refused_and_truncated_responses():
+    output = batch_output(
+        ("0", {"content": None, "refusal": "I can't help with that."}),
+        ("1", {"content": '{"document_type": "inv'}),
+        ("2", analysis_message("invoice")),
+    )
+
+    assert parse_batch_output(output, 3) == [None, None, "invoice"]
+
+
+def test_split_batch_input_respects_request_and_size_limits():
+    requests = ["a" * 9, "b" * 9, "c" * 9, "d" * 9, "e" * 9]
+
+    assert list(split_batch_input(requests, max_requests=2)) == [
+        b"aaaaaaaaa\nbbbbbbbbb\n",
+        b"ccccccccc\nddddddddd\n",
+        b"eeeeeeeee\n",
+    ]
+    assert list(split_batch_input(requests, max_bytes=25)) == [
+        b"aaaaaaaaa\nbbbbbbbbb\n",
+        b"ccccccccc\nddddddddd\n",
+        b"eeeeeeeee\n",
+    ]
+    assert list(split_batch_input(requests, max_bytes=10)) == [
+        line.encode() + b"\n" for line in requests
+    ]
+
+
+def test_document_analysis_response_format_matches_sdk_request():
+    cassette_path = os.path.join(CASSETTES_DIR, "invoice_1.pdf.yaml")
+    with open(cassette_path, "rb") as f:
+        cassette = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    request_body = json.loads(cassette["interactions"][0]["request"]["body"])
+
+    assert document_analysis_response_format() == request_body["response_format"]
+
+
+def test_classify_files_async_preserves_order(mocker):
+    invoice, statement = make_png((10, 10)), make_png((20, 20))
+    invoice_url = f"data:image/png;base64,{base64.b64encode(invoice).decode()}"
+
+    async def parse(model, messages, response_format):
+        image_url = messages[1]["content"][1]["image_url"]["url"]
+        completion = mocker.MagicMock()
+        completion.choices[0].message.parsed.document_type = (
+            "invoice" if image_url == invoice_url else "bank_statement"
+        )
+        return completion
+
+    aclient = mocker.patch("src.openai_classifier.get_async_client").return_value
+    aclient.beta.chat.completions.parse = mocker.AsyncMock(side_effect=parse)
+
+    files = [
+        FileStorage(stream=BytesIO(invoice), filename="invoice.png"),
+        FileStorage(stream=BytesIO(statement), filename="statement.png"),
+    ]
+
+    assert asyncio.run(classify_files_async(files)) == ["invoice", "bank_statement"]
+    assert aclient.beta.chat.completions.parse.await_count == 2
+
+
+def test_classify_file_caches_identical_content(mocker):
+    query_gpt4 = mocker.patch("src.openai_classifier.query_gpt4")
+    query_gpt4.return_value.choices[0].message.parsed.document_type = "invoice"
+
+    for filename in ["first.pdf", "renamed_copy.pdf"]:
+        file_storage = FileStorage(stream=BytesIO(b"cached content"), filename=filename)
+        assert classify_file(file_storage) == "invoice"
+
+    query_gpt4.assert_called_once()
+
+
+def test_classify_files_async_caches_identical_content(mocker):
+    query_gpt4_async = mocker.patch(
+        "src.openai_classifier.query_gpt4_async", new_callable=mocker.AsyncMock
+    )
+    query_gpt4_async.return_value.choices[0].message.parsed.document_type = "invoice"
+
+    for filename in ["first.pdf", "renamed_copy.pdf"]:
+        file_storage = FileStorage(stream=BytesIO(b"cached content"), filename=filename)
+        assert asyncio.run(classify_files_async([file_storage])) == ["invoice"]
+
+    query_gpt4_async.assert_awaited_once()
+
+
+@pytest.mark.parametrize(
+    "head, expected_mime_type",
+    [
+        (b"\xff\xd8\xff\xe0\x00\x10JFIF", "image/jpeg"),
+        (b"\x89PNG\r\n\x1a\n\x00\x00\x00\r", "image/png"),
+        (b"RIFF\x24\x00\x00\x00WEBPVP8 ", "image/webp"),
+        (b"GIF89a\x01\x00\x01\x00", "image/gif"),
+        (b"%PDF-1.7\n%\xe2\xe3", "application/pdf"),
+        (b"just some text", None),
+        (b"", None),
+    ],
+)
+def test_sniff_mime_type(head, expected_mime_type):
+    assert sniff_mime_type(head) == expected_mime_type
+
+
+def test_convert_pdf_to_jpeg_caches_pages_on_disk(mocker, tmp_path):
+    rasterize_pdf = mocker.patch(
+        "src.openai_classifier.rasterize_pdf", return_value=(b"page 1", b"page 2")
+    )
+
+    # Without a cache directory every call renders the PDF
+    for _ in range(2):
+        assert convert_pdf_to_jpeg(b"%PDF cached pages") == [b"page 1", b"page 2"]
+    assert rasterize_pdf.call_count == 2
+
+    rasterize_pdf.reset_mock()
+    with diskcache.Cache(tmp_path) as page_cache:
+        mocker.patch("src.openai_classifier.page_cache", page_cache)
+
+        for _ in range(2):
+            assert convert_pdf_to_jpeg(b"%PDF cached pages") == [b"page 1", b"page 2"]
+        assert convert_pdf_to_jpeg(b"%PDF cached pages", dpi=100) == [
+            b"page 1",
+            b"page 2",
+        ]
+        assert rasterize_pdf.call_count == 2
+
+        # A digest the caller already computed is used as the key as-is
+        digest = hashlib.sha256(b"%PDF cached pages").hexdigest()
+        assert convert_pdf_to_jpeg(b"", digest=digest) == [b"page 1", b"page 2"]
+        assert rasterize_pdf.call_count == 2
+
+
+def test_open_file_bytes_maps_real_files():
+    file_path = os.path.join(FILES_DIR, "invoice_1.pdf")
+    with open(file_path, "rb") as f:
+        expected = f.read()
+
+    with closing(create_filestorage_from_path(file_path)) as file_storage:
+        with open_file_bytes(file_storage) as file_bytes:
+            assert isinstance(file_bytes, mmap.mmap)
+            assert file_bytes[:] == expected
+
+    in_memory = FileStorage(stream=BytesIO(expected), filename="invoice_1.pdf")
+    with open_file_bytes(in_memory) as file_bytes:
+        assert file_bytes == expected
+
+
+def test_open_file_bytes_reads_from_the_current_position():
+    file_path = os.path.join(FILES_DIR, "invoice_1.pdf")
+    with open(file_path, "rb") as f:
+        expected = f.read()
+
+    with closing(create_filestorage_from_path(file_path)) as file_storage:
+        file_storage.read(4)
+        with open_file_bytes(file_storage) as file_bytes:
+            assert isinstance(file_bytes, bytes)
+            assert file_bytes == expected[4:]
+
+
+def test_open_file_bytes_keeps_spooled_uploads_in_memory():
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+        spool.write(b"x" * 1024)
+        spool.seek(0)
+        file_storage = FileStorage(stream=spool, filename="upload.pdf")
+
+        with open_file_bytes(file_storage) as file_bytes:
+            assert isinstance(file_bytes, bytes)
+            assert file_bytes == b"x" * 1024